@@ -2,20 +2,122 @@
 JAO Adapter for Ingress.
 """
 import argparse
+import functools
 import json
+import os
+from concurrent.futures import ThreadPoolExecutor
 from configparser import ConfigParser
 from datetime import datetime
 import logging
 import logging.config
+import re
+import tempfile
 import requests
 
 from dateutil.relativedelta import relativedelta
+from requests.adapters import HTTPAdapter, Retry
 from osiris.apis.ingress import Ingress
 from osiris.core.azure_client_authorization import ClientAuthorization
 from osiris.adapters.ingress_adapter import IngressAdapter
 
+try:
+    import orjson
+except ImportError:
+    orjson = None  # type: ignore
+
 logger = logging.getLogger(__file__)
 
+MAX_FETCH_WORKERS = 16
+
+# Connect and read timeouts in seconds - a hung JAO request must not block the run.
+REQUEST_TIMEOUT = (5, 30)
+
+# Responses are spooled to disk beyond this size instead of being held in memory.
+SPOOL_MAX_BYTES = 16 * 1024 * 1024
+
+ONE_MONTH = relativedelta(months=+1)
+
+CORRIDOR_FILTERS = ('DK', 'D1', 'D2')
+_CORRIDOR_FILTER_RE = re.compile('|'.join(map(re.escape, CORRIDOR_FILTERS)))
+
+
+@functools.lru_cache(maxsize=256)
+def _parse_corridor_date(date_str):
+    """
+    Parses an ISO corridor date. Cached since many corridors share the same
+    (default) date, and fromisoformat is much faster than strptime.
+    """
+    return datetime.fromisoformat(date_str[:10])
+
+
+@functools.lru_cache(maxsize=None)
+def _get_client_auth(tenant_id, client_id, client_secret):
+    """
+    Returns a ClientAuthorization shared across adapter constructions, so the
+    acquired token is reused instead of negotiated per instance.
+    """
+    return ClientAuthorization(tenant_id=tenant_id, client_id=client_id, client_secret=client_secret)
+
+
+@functools.lru_cache(maxsize=None)
+def _get_ingress(ingress_url, dataset_guid, tenant_id, client_id, client_secret):
+    """
+    Returns an Ingress client shared across adapter constructions.
+    """
+    client_auth = _get_client_auth(tenant_id, client_id, client_secret)
+    return Ingress(client_auth, ingress_url, dataset_guid)
+
+
+@functools.lru_cache(maxsize=4)
+def _read_config(file_paths, file_mtimes):  # pylint: disable=unused-argument
+    """
+    Parses the given configuration files.
+    The modification times are part of the cache key, so edited files are re-read.
+    """
+    config = ConfigParser()
+    config.read(file_paths)
+    return config
+
+
+def _load_config(file_paths):
+    """
+    Returns the parsed configuration, cached until one of the files changes on disk.
+    """
+    file_mtimes = tuple(os.path.getmtime(path) for path in file_paths if os.path.exists(path))
+    return _read_config(tuple(file_paths), file_mtimes)
+
+
+@functools.lru_cache(maxsize=None)
+def _configure_logging(configuration_file, disable_logger_labels=()):
+    """
+    Configures logging from file. Cached, so repeated adapter runs in the same
+    process only pay the fileConfig cost once.
+    """
+    logging.config.fileConfig(fname=configuration_file,  # type: ignore
+                              disable_existing_loggers=False)
+
+    # To disable azure INFO logging from Azure
+    for logger_label in disable_logger_labels:
+        logging.getLogger(logger_label).setLevel(logging.WARNING)
+
+
+def _json_loads(content):
+    """
+    Deserializes JSON bytes, using orjson when available.
+    """
+    if orjson is not None:
+        return orjson.loads(content)
+    return json.loads(content)
+
+
+def _state_fingerprint(json_content):
+    """
+    Returns a fingerprint of the serialized state, used to detect changes.
+    """
+    if orjson is not None:
+        return hash(orjson.dumps(json_content, option=orjson.OPT_SORT_KEYS))
+    return hash(json.dumps(json_content, sort_keys=True))
+
 
 class JaoClient:
     """
@@ -26,25 +128,57 @@ class JaoClient:
         self.auth_api_key = auth_api_key
         self.horizon = horizon
 
+        self._horizons_url = f'{jao_url}/gethorizons'
+        self._corridors_url = f'{jao_url}/getcorridors'
+        self._auctions_url = f'{jao_url}/getauctions'
+        self._curtailment_url = f'{jao_url}/getcurtailment'
+        self._bids_url = f'{jao_url}/getbids'
+
+        # Horizons and corridors are near-static reference data - fetched once per client.
+        self._horizons = None
+        self._corridors = None
+
+        self.session = requests.Session()
+        self.session.headers.update({'AUTH_API_KEY': auth_api_key,
+                                     'Accept': 'application/json',
+                                     'Accept-Encoding': 'gzip, deflate, br'})
+        retries = Retry(total=3, backoff_factor=0.3, status_forcelist=[502, 503, 504])
+        # The pool is sized to the fetch worker count, so all threads share pooled connections.
+        self.session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=MAX_FETCH_WORKERS,
+                                                   max_retries=retries))
+
+    def close(self):
+        """
+        Closes the HTTP session and its connection pool.
+        """
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
     def get_horizons(self):
         """
         Returns all the Horizon names in JSON format.
+        The result is cached on the client after the first call.
         """
-        response = requests.get(
-            url=f'{self.jao_url}/gethorizons',
-            headers={'AUTH_API_KEY': self.auth_api_key}
-        )
-        return json.loads(response.content)
+        if self._horizons is None:
+            response = self.session.get(url=self._horizons_url, timeout=REQUEST_TIMEOUT, allow_redirects=False)
+            self._horizons = _json_loads(response.content)
+        return self._horizons
 
     def get_corridors(self):
         """
         Returns all the corridors in JSON format.
+        The result is cached on the client after the first call.
         """
-        response = requests.get(
-            url=f'{self.jao_url}/getcorridors',
-            headers={'AUTH_API_KEY': self.auth_api_key}
-        )
-        return json.loads(response.content)
+        if self._corridors is None:
+            response = self.session.get(url=self._corridors_url, timeout=REQUEST_TIMEOUT, allow_redirects=False)
+            logger.debug('Content-Encoding negotiated with JAO: %s', response.headers.get('Content-Encoding'))
+            self._corridors = _json_loads(response.content)
+        return self._corridors
 
     def get_auctions(self, corridor, from_date, to_date=None):
         """
@@ -54,21 +188,29 @@ class JaoClient:
         :param corridor: The corridor to get data from.
         :param from_date: The date starting from.
         :param to_date: The end date (optional).
-        :return: Returns the actions as JSON.
+        :return: Returns the auctions as raw JSON bytes, or None when no data is available.
         """
+        params = {'corridor': corridor, 'fromdate': from_date, 'horizon': self.horizon}
         if to_date:
-            raise Exception("to_date argument not used")
+            params['todate'] = to_date
 
-        response = requests.get(
-            url=f'{self.jao_url}/getauctions',
-            params={'corridor': corridor, 'fromdate': from_date, 'horizon': self.horizon},
-            headers={'AUTH_API_KEY': self.auth_api_key}
+        response = self.session.get(
+            url=self._auctions_url,
+            params=params,
+            timeout=REQUEST_TIMEOUT,
+            allow_redirects=False
         )
-        if response.status_code == 200:
-            return json.loads(response.content)
-        # The challenge is, that bad request can be: no data available.
-        # Bad response
-        # - we ignore bad response, as it might not be a bad request, but just no data available
+        if response.status_code >= 500:
+            response.raise_for_status()
+        if response.status_code != 200:
+            # The challenge is, that bad request can be: no data available.
+            # - we ignore bad request, as it might just be no data available
+            return None
+
+        content = response.content
+        # Auction data is a non-empty JSON array - an error payload is a JSON object.
+        if content.startswith(b'[') and content != b'[]':
+            return content
         return None
 
     def get_curtailment(self, corridor, from_date, to_date=None):
@@ -80,15 +222,17 @@ class JaoClient:
         :param to_date: The end date (optional).
         :return: Returns the curtailments as JSON.
         """
+        params = {'corridor': corridor, 'fromdate': from_date}
         if to_date:
-            raise Exception("to_date argument not used")
+            params['todate'] = to_date
 
-        response = requests.get(
-            url=f'{self.jao_url}/getcurtailment',
-            params={'corridor': corridor, 'fromdate': from_date},
-            headers={'AUTH_API_KEY': self.auth_api_key}
+        response = self.session.get(
+            url=self._curtailment_url,
+            params=params,
+            timeout=REQUEST_TIMEOUT,
+            allow_redirects=False
         )
-        return json.loads(response.content)
+        return _json_loads(response.content)
 
     def get_bids(self, auction_id):
         """
@@ -97,12 +241,13 @@ class JaoClient:
         :param auction_id:
         :return:
         """
-        response = requests.get(
-            url=f'{self.jao_url}/getbids',
+        response = self.session.get(
+            url=self._bids_url,
             params={'auctionid': auction_id},
-            headers={'AUTH_API_KEY': self.auth_api_key}
+            timeout=REQUEST_TIMEOUT,
+            allow_redirects=False
         )
-        return json.loads(response.content)
+        return _json_loads(response.content)
 
 
 class CorridorState:
@@ -115,13 +260,18 @@ class CorridorState:
             raise ValueError('Horizon not valid value: Valid values are Yearly and Monthly')
         self.json_content = ingress.retrieve_state()
         self.state = self.json_content[horizon]
+        self._index = {item['Corridor']: item for item in self.state}
 
         self.ingress = ingress
         self.horizon = horizon
         self.default_value = default_date
+        self._fingerprint = _state_fingerprint(self.json_content)
 
     def __str__(self):
-        return '\n'.join([str(item) for item in self.state])
+        return '\n'.join(str(item) for item in self.state)
+
+    def __repr__(self):
+        return f'CorridorState(horizon={self.horizon}, corridors={len(self.state)})'
 
     def get_last_successful_monthly_date(self, corridor):
         """
@@ -129,12 +279,10 @@ class CorridorState:
         :param corridor:
         :return:
         """
-        monthly_date = self.default_value
-        for item in self.state:
-            if item['Corridor'] == corridor:
-                monthly_date = item['LastSuccessfulMonthlyDate']
-                return monthly_date.split('T')[0]
-        return monthly_date.split('T')[0]
+        item = self._index.get(corridor)
+        if item is None:
+            return self.default_value[:10]
+        return item['LastSuccessfulMonthlyDate'][:10]
 
     def set_last_successful_monthly_date(self, corridor, monthly_date):
         """
@@ -143,19 +291,26 @@ class CorridorState:
         :param monthly_date:
         :return:
         """
-        for item in self.state:
-            if item['Corridor'] == corridor:
-                item['LastSuccessfulMonthlyDate'] = monthly_date
-                return
-        self.state.append({'Corridor': corridor, 'LastSuccessfulMonthlyDate': monthly_date})
+        item = self._index.get(corridor)
+        if item is None:
+            item = {'Corridor': corridor, 'LastSuccessfulMonthlyDate': monthly_date}
+            self.state.append(item)
+            self._index[corridor] = item
+        else:
+            item['LastSuccessfulMonthlyDate'] = monthly_date
 
     def save_state(self):
         """
-        Saves the state.
+        Saves the state, unless nothing has changed since it was loaded.
         :return:
         """
         self.json_content[self.horizon] = self.state
+        fingerprint = _state_fingerprint(self.json_content)
+        if fingerprint == self._fingerprint:
+            logger.debug('State unchanged, skipping save')
+            return
         self.ingress.save_state(self.json_content)
+        self._fingerprint = fingerprint
 
 
 class JaoAdapter(IngressAdapter):
@@ -172,19 +327,16 @@ class JaoAdapter(IngressAdapter):
                  jao_auth_api_key: str,
                  default_value: str,
                  horizon: str):
-        client_auth = ClientAuthorization(tenant_id, client_id, client_secret)
+        client_auth = _get_client_auth(tenant_id, client_id, client_secret)
         super().__init__(client_auth=client_auth, ingress_url=ingress_url, dataset_guid=dataset_guid)
 
-        client_auth = ClientAuthorization(tenant_id=tenant_id, client_id=client_id, client_secret=client_secret)
-        ingress = Ingress(client_auth,
-                          ingress_url,
-                          dataset_guid)
+        ingress = _get_ingress(ingress_url, dataset_guid, tenant_id, client_id, client_secret)
 
         self.state = CorridorState(ingress, horizon, default_value)
 
         self.client = JaoClient(jao_server_url, jao_auth_api_key, horizon)
 
-    def retrieve_data(self) -> bytes:
+    def retrieve_data(self) -> bytes:  # pylint: disable=too-many-locals
         """
         Retrives the data from JAO based on the state and returns it.
         :return:
@@ -193,30 +345,51 @@ class JaoAdapter(IngressAdapter):
 
         current_date = datetime.utcnow()
 
-        corridors_all = self.client.get_corridors()
+        corridors = [corridor['value'] for corridor in self.client.get_corridors()
+                     if _CORRIDOR_FILTER_RE.search(corridor['value'])]
 
-        corridors_all = [corridor['value'] for corridor in corridors_all]
-        corridors = self.__filter_corridors(corridors_all, ['DK', 'D1', 'D2'])
+        current_month_start = current_date.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
 
-        all_corridor_actions = []
+        work_items = []
         for corridor in corridors:
             monthly_date = self.state.get_last_successful_monthly_date(corridor)
-            monthly_datetime_obj = datetime.strptime(monthly_date, '%Y-%m-%d')
-
-            while monthly_datetime_obj < current_date:
-                monthly_datetime_str = monthly_datetime_obj.strftime("%Y-%m-%d")
-                logger.debug('Retrieving corridor: %s for %s', corridor, monthly_datetime_str)
-
-                auctions = self.client.get_auctions(corridor, monthly_datetime_str)
-                if auctions:
-                    all_corridor_actions.append({'corridor': corridor, 'from_date': monthly_datetime_str,
-                                                 'response': auctions})
-                    self.state.set_last_successful_monthly_date(corridor, monthly_datetime_str)
+            monthly_datetime_obj = _parse_corridor_date(monthly_date)
 
-                monthly_datetime_obj += relativedelta(months=+1)
+            # The last successful month is the current month - no new auction period can exist yet.
+            if monthly_datetime_obj.replace(day=1) >= current_month_start:
+                logger.debug('Corridor %s is already up to date, skipping', corridor)
+                continue
 
-        logger.debug('Save state and return response data')
-        return json.dumps(all_corridor_actions).encode('utf_8')
+            while monthly_datetime_obj < current_date:
+                work_items.append((corridor, monthly_datetime_obj.date().isoformat()))
+                monthly_datetime_obj += ONE_MONTH
+
+        get_auctions = self.client.get_auctions
+
+        def fetch(work_item):
+            corridor, monthly_datetime_str = work_item
+            logger.debug('Retrieving corridor: %s for %s', corridor, monthly_datetime_str)
+            return get_auctions(corridor, monthly_datetime_str)
+
+        set_last_successful = self.state.set_last_successful_monthly_date
+        with tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_BYTES) as spool, \
+                ThreadPoolExecutor(max_workers=MAX_FETCH_WORKERS) as executor:
+            write = spool.write
+            write(b'[')
+            first = True
+            for (corridor, monthly_datetime_str), auctions in zip(work_items, executor.map(fetch, work_items)):
+                if auctions is not None:
+                    if not first:
+                        write(b', ')
+                    write(b'{"corridor": "' + corridor.encode() + b'", "from_date": "'
+                          + monthly_datetime_str.encode() + b'", "response": ' + auctions + b'}')
+                    first = False
+                    set_last_successful(corridor, monthly_datetime_str)
+            write(b']')
+
+            logger.debug('Save state and return response data')
+            spool.seek(0)
+            return spool.read()
 
     def save_state(self):
         self.state.save_state()
@@ -228,22 +401,6 @@ class JaoAdapter(IngressAdapter):
     def get_event_time(self) -> str:
         pass
 
-    @staticmethod
-    def __filter_corridors(corridors, filters):
-        """
-        Helper function used to filter the needed corridors.
-        :param corridors:
-        :param filters:
-        :return:
-        """
-        result = []
-        for corridor in corridors:
-            for filter_item in filters:
-                if filter_item in corridor:
-                    result.append(corridor)
-                    break
-        return result
-
 
 def __init_argparse() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser(description='Ingress adapter for JAO')
@@ -267,19 +424,14 @@ def ingest_jao_auctions_data():
     arg_parser = __init_argparse()
     args, _ = arg_parser.parse_known_args()
 
-    config = ConfigParser()
-    config.read(args.conf)
-    credentials_config = ConfigParser()
-    credentials_config.read(args.credentials)
-
-    logging.config.fileConfig(fname=config['Logging']['configuration_file'],  # type: ignore
-                              disable_existing_loggers=False)
+    config = _load_config(args.conf)
+    credentials_config = _load_config(args.credentials)
 
-    # To disable azure INFO logging from Azure
+    disable_logger_labels = ()
     if config.has_option('Logging', 'disable_logger_labels'):
-        disable_logger_labels = config['Logging']['disable_logger_labels'].splitlines()
-        for logger_label in disable_logger_labels:
-            logging.getLogger(logger_label).setLevel(logging.WARNING)
+        disable_logger_labels = tuple(config['Logging']['disable_logger_labels'].splitlines())
+
+    _configure_logging(config['Logging']['configuration_file'], disable_logger_labels)
 
     logger.info('Starting adapter')
     adapter = JaoAdapter(config['Azure Storage']['ingress_url'],